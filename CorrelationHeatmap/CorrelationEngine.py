@@ -0,0 +1,360 @@
+import pandas as pd
+import numpy as np
+import json
+import ast
+import os
+import tempfile
+import logging
+
+
+class SeriesBuilder:
+    """把新闻数据聚合成按时间桶对齐的类别 / 股票时间序列"""
+
+    METRICS = ['volume', 'sentiment', 'keyword_intensity']
+
+    def __init__(self, freq='h'):
+        self.freq = freq
+
+    @staticmethod
+    def parse_list(value):
+        """解析 JSON 或 Python 字面量形式的列表字段"""
+        if isinstance(value, list):
+            return value
+        if not isinstance(value, str) or not value.strip():
+            return []
+        for parser in (json.loads, ast.literal_eval):
+            try:
+                parsed = parser(value)
+                return parsed if isinstance(parsed, list) else []
+            except (ValueError, SyntaxError):
+                continue
+        return []
+
+    @staticmethod
+    def signed_sentiment(df):
+        """SentimentAnalyzer 输出的分数为绝对值，这里按标签还原正负号；未分析的文章记为 NaN"""
+        if 'sentiment_score' not in df.columns:
+            return pd.Series(np.nan, index=df.index)
+        sign = np.where(df['sentiment_label'] == '负面', -1.0, 1.0)
+        return df['sentiment_score'].astype(float) * sign
+
+    def prepare(self, df, raw_df=None):
+        """整理出 bucket / categoryName / stock / sentiment / keyword_count 列"""
+        df = df.drop_duplicates('newsId', keep='last').copy()
+        df['publishAt'] = pd.to_datetime(df['publishAt'], errors='coerce')
+        df = df.dropna(subset=['publishAt'])
+        df['bucket'] = df['publishAt'].dt.floor(self.freq)
+        df['sentiment'] = self.signed_sentiment(df)
+        df['keyword_count'] = df['keyword'].map(lambda v: len(self.parse_list(v)))
+
+        # 转换后的数据不含股票代码，从原始数据按 newsId 补回
+        if raw_df is not None and 'stock' in raw_df.columns:
+            stocks = raw_df.drop_duplicates('newsId', keep='last').set_index('newsId')['stock']
+            df['stock'] = df['newsId'].map(stocks).map(self.parse_list)
+        else:
+            df['stock'] = [[] for _ in range(len(df))]
+        return df
+
+    def aggregate(self, df, key, kind):
+        """按 (bucket, key) 计算三个指标并展开成宽表"""
+        grouped = df.groupby(['bucket', key]).agg(
+            volume=('newsId', 'size'),
+            sentiment=('sentiment', 'mean'),
+            keyword_intensity=('keyword_count', 'mean'),
+        )
+        wide = grouped[self.METRICS].unstack(key)
+        wide.columns = [f"{kind}:{name}:{metric}" for metric, name in wide.columns]
+        return wide
+
+    def build(self, df, raw_df=None):
+        """生成宽表：行为连续的时间桶，列为 "类型:名称:指标"
+
+        无文章的桶里 volume 记为 0，sentiment 与 keyword_intensity 没有定义，保留为 NaN，
+        由 CorrelationEngine 按成对有效样本计算相关系数。
+        """
+        df = self.prepare(df, raw_df)
+        if df.empty:
+            return pd.DataFrame()
+
+        frames = [self.aggregate(df, 'categoryName', 'category')]
+        tickers = df[['newsId', 'bucket', 'sentiment', 'keyword_count', 'stock']].explode('stock')
+        tickers = tickers.dropna(subset=['stock'])
+        if not tickers.empty:
+            frames.append(self.aggregate(tickers, 'stock', 'ticker'))
+
+        wide = pd.concat(frames, axis=1)
+        full_index = pd.date_range(wide.index.min(), wide.index.max(), freq=self.freq)
+        wide = wide.reindex(full_index).sort_index(axis=1)
+        volume_columns = [c for c in wide.columns if c.endswith(':volume')]
+        wide[volume_columns] = wide[volume_columns].fillna(0.0)
+        return wide
+
+
+class CorrelationEngine:
+    """可增量更新的全量 / 滚动窗口相关系数矩阵
+
+    NaN 表示该桶没有数据，相关系数只用两条序列同时有值的桶计算（与 DataFrame.corr 一致）。
+    全量统计量保存成对的样本数、列和、平方和与交叉乘积，新时间桶到来时只需累加这一批的矩阵乘积。
+    最近 history 个桶保留原始值，重新聚合后数值有变化的桶会先减去旧值再加上新值；
+    更早的桶只保留校验和，一旦发生变化就用传入的整份数据重新计算。
+    新出现的序列只从出现之后开始参与统计。
+    """
+
+    def __init__(self, window=24 * 7, freq='h', source='', history=24 * 30):
+        if history < window:
+            raise ValueError(f"history ({history}) 不能小于 window ({window})")
+        self.window = window
+        self.freq = freq
+        self.source = source
+        self.history = history
+        self._reset()
+
+    def _reset(self):
+        """清空所有统计量，保留配置"""
+        self.labels = []
+        self.last_bucket = None
+        self.count = 0
+        self.shift = np.zeros(0)
+        self.pair_count = np.zeros((0, 0))
+        self.pair_sums = np.zeros((0, 0))
+        self.pair_squares = np.zeros((0, 0))
+        self.cross = np.zeros((0, 0))
+        self.buffer = np.zeros((0, 0))
+        self.buffer_index = pd.DatetimeIndex([])
+        self.checksums = pd.DataFrame({'hash': np.zeros(0, dtype=np.uint64),
+                                       'width': np.zeros(0, dtype=np.int64)},
+                                      index=pd.DatetimeIndex([]))
+
+    def config(self):
+        """决定缓存能否复用的配置"""
+        return {'window': self.window, 'freq': self.freq, 'source': self.source, 'history': self.history}
+
+    @staticmethod
+    def _row_hashes(frame):
+        """每个时间桶一行数值的校验和"""
+        return pd.util.hash_pandas_object(frame, index=False).to_numpy()
+
+    @staticmethod
+    def _pairwise_stats(values, shift):
+        """返回成对的样本数、列和、平方和与交叉乘积；[i, j] 只统计 i 与 j 同时有值的桶"""
+        mask = ~np.isnan(values)
+        x = np.where(mask, values - shift, 0.0)
+        m = mask.astype(np.float64)
+        return m.T @ m, x.T @ m, (x * x).T @ m, x.T @ x
+
+    def _accumulate(self, values, sign=1.0):
+        """把若干行加入（sign=1）或移出（sign=-1）全量统计量"""
+        if len(values) == 0:
+            return
+        count, sums, squares, cross = self._pairwise_stats(values, self.shift)
+        self.pair_count += sign * count
+        self.pair_sums += sign * sums
+        self.pair_squares += sign * squares
+        self.cross += sign * cross
+
+    def _grow(self, new_labels):
+        """加入新出现的序列；此前的桶视为缺失，因此统计量只需补零"""
+        pad = len(new_labels)
+        self.labels = self.labels + list(new_labels)
+        self.shift = np.concatenate([self.shift, np.zeros(pad)])
+        for name in ('pair_count', 'pair_sums', 'pair_squares', 'cross'):
+            setattr(self, name, np.pad(getattr(self, name), ((0, pad), (0, pad))))
+        self.buffer = np.pad(self.buffer, ((0, 0), (0, pad)), constant_values=np.nan)
+
+    def _history_changed(self, frame):
+        """检查缓冲区之外、已处理过的桶是否与当初的数值不同
+
+        校验和只覆盖该桶处理时已有的序列，之后新出现的序列在旧桶里的值不参与比较。
+        """
+        if self.last_bucket is None:
+            return False
+        old = frame[(frame.index <= self.last_bucket) & ~frame.index.isin(self.buffer_index)]
+        if old.empty:
+            return False
+        stored = self.checksums.reindex(old.index)
+        if stored['hash'].isna().any():
+            return True
+        for width, rows in stored.groupby('width').groups.items():
+            hashes = self._row_hashes(old.loc[rows, self.labels[:int(width)]])
+            if (hashes != stored.loc[rows, 'hash'].to_numpy(dtype=np.uint64)).any():
+                return True
+        return False
+
+    def _revise(self, frame):
+        """用新值替换仍在缓冲区内的桶，返回尚未处理过的新桶"""
+        if self.last_bucket is None:
+            return frame
+
+        in_buffer = frame.index.isin(self.buffer_index)
+        if in_buffer.any():
+            rows = self.buffer_index.get_indexer(frame.index[in_buffer])
+            old = self.buffer[rows]
+            new = frame[in_buffer].to_numpy(dtype=np.float64)
+            changed = ~((old == new) | (np.isnan(old) & np.isnan(new))).all(axis=1)
+            if changed.any():
+                self._accumulate(old[changed], sign=-1.0)
+                self._accumulate(new[changed])
+                self.buffer[rows[changed]] = new[changed]
+                revised = frame[in_buffer][changed]
+                for width, buckets in self.checksums.loc[revised.index].groupby('width').groups.items():
+                    self.checksums.loc[buckets, 'hash'] = self._row_hashes(
+                        revised.loc[buckets, self.labels[:int(width)]])
+                logging.info(f"更新了 {int(changed.sum())} 个已处理过的时间桶")
+
+        return frame[frame.index > self.last_bucket]
+
+    def update(self, frame):
+        """追加或修订时间桶（宽表，行为时间，列为序列）并增量更新统计量
+
+        传入整份重新聚合的数据时，缓冲区之外的旧桶若有变化会整体重新计算；
+        只传入新桶时旧桶不参与比较。
+        """
+        frame = frame.sort_index()
+        new_labels = [c for c in frame.columns if c not in set(self.labels)]
+        if new_labels:
+            self._grow(new_labels)
+        frame = frame.reindex(columns=self.labels).astype(np.float64)
+        if self._history_changed(frame):
+            logging.warning(f"最近 {self.history} 个时间桶之前的数据有变化，重新计算全部统计量")
+            labels = self.labels
+            self._reset()
+            self._grow(labels)
+        frame = self._revise(frame)
+        if frame.empty:
+            return self
+
+        start = frame.index.min() if self.last_bucket is None else \
+            self.last_bucket + pd.tseries.frequencies.to_offset(self.freq)
+        frame = frame.reindex(pd.date_range(start, frame.index.max(), freq=self.freq))
+        values = frame.to_numpy(dtype=np.float64)
+        if self.count == 0:
+            # 以第一批的均值作为平移量，减小累加平方和时的数值误差
+            valid = ~np.isnan(values)
+            totals = np.where(valid, values, 0.0).sum(axis=0)
+            self.shift = totals / np.maximum(valid.sum(axis=0), 1)
+        self._accumulate(values)
+        self.count += len(values)
+
+        new_checksums = pd.DataFrame({'hash': self._row_hashes(frame),
+                                      'width': len(self.labels)}, index=frame.index)
+        self.checksums = new_checksums if self.checksums.empty else pd.concat([self.checksums, new_checksums])
+        self.buffer = np.vstack([self.buffer, values])[-self.history:]
+        self.buffer_index = self.buffer_index.append(frame.index)[-self.history:]
+        self.last_bucket = frame.index[-1]
+        return self
+
+    @staticmethod
+    def _to_corr(pair_count, pair_sums, pair_squares, cross):
+        """由成对统计量计算相关系数；有效样本少于 2 个或方差为 0 时记为 NaN"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = cross - pair_sums * pair_sums.T / pair_count
+            var = pair_squares - pair_sums ** 2 / pair_count
+            corr = cov / np.sqrt(var * var.T)
+        corr[(pair_count < 2) | (var < 1e-12) | (var.T < 1e-12)] = np.nan
+        return np.clip(corr, -1.0, 1.0)
+
+    def correlation(self):
+        """全部历史数据的相关系数矩阵"""
+        corr = self._to_corr(self.pair_count, self.pair_sums, self.pair_squares, self.cross)
+        return pd.DataFrame(corr, index=self.labels, columns=self.labels)
+
+    def rolling_correlation(self):
+        """最近 window 个时间桶的相关系数矩阵"""
+        corr = self._to_corr(*self._pairwise_stats(self.buffer[-self.window:], self.shift))
+        return pd.DataFrame(corr, index=self.labels, columns=self.labels)
+
+    def rolling_correlation_with(self, target, window=None):
+        """所有序列与 target 的逐桶滚动相关系数（累积和实现，行为时间）
+
+        只覆盖缓冲区内最近 history 个时间桶，window 默认为引擎的 window。
+        """
+        if window is None:
+            window = self.window
+        if target not in self.labels:
+            raise ValueError(f"未知序列：{target}")
+        if not 2 <= window <= self.history:
+            raise ValueError(f"window 必须介于 2 与缓存的历史长度 {self.history} 之间，当前为 {window}")
+
+        values = self.buffer
+        y = values[:, [self.labels.index(target)]]
+        mask = ~np.isnan(values) & ~np.isnan(y)
+        x = np.where(mask, values, 0.0)
+        y = np.where(mask, y, 0.0)
+
+        def rolling_sum(a):
+            c = np.cumsum(a, axis=0)
+            c[window:] = c[window:] - c[:-window]
+            return c[window - 1:]
+
+        n = rolling_sum(mask.astype(np.float64))
+        sx, sy = rolling_sum(x), rolling_sum(y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = rolling_sum(x * y) - sx * sy / n
+            var_x = rolling_sum(x * x) - sx ** 2 / n
+            var_y = rolling_sum(y * y) - sy ** 2 / n
+            corr = cov / np.sqrt(var_x * var_y)
+        corr[(n < 2) | (var_x < 1e-12) | (var_y < 1e-12)] = np.nan
+        return pd.DataFrame(np.clip(corr, -1.0, 1.0),
+                            index=self.buffer_index[window - 1:], columns=self.labels)
+
+    def save(self, path):
+        """把统计量缓存为 .npz（不压缩），先写临时文件再替换，避免中断时留下损坏的缓存"""
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        last_bucket = '' if self.last_bucket is None else self.last_bucket.isoformat()
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.npz.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(
+                    f,
+                    config=json.dumps(self.config(), ensure_ascii=False),
+                    labels=np.array(self.labels, dtype=str), last_bucket=last_bucket,
+                    count=self.count, shift=self.shift, pair_count=self.pair_count,
+                    pair_sums=self.pair_sums, pair_squares=self.pair_squares, cross=self.cross,
+                    buffer=self.buffer, buffer_index=self.buffer_index.to_numpy(dtype='datetime64[ns]'),
+                    checksum_index=self.checksums.index.to_numpy(dtype='datetime64[ns]'),
+                    checksum_hash=self.checksums['hash'].to_numpy(dtype=np.uint64),
+                    checksum_width=self.checksums['width'].to_numpy(dtype=np.int64),
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """从缓存恢复引擎"""
+        with np.load(path, allow_pickle=False) as data:
+            engine = cls(**json.loads(str(data['config'])))
+            engine.labels = data['labels'].tolist()
+            last_bucket = str(data['last_bucket'])
+            engine.last_bucket = pd.Timestamp(last_bucket) if last_bucket else None
+            engine.count = int(data['count'])
+            engine.shift = data['shift']
+            engine.pair_count = data['pair_count']
+            engine.pair_sums = data['pair_sums']
+            engine.pair_squares = data['pair_squares']
+            engine.cross = data['cross']
+            engine.buffer = data['buffer']
+            engine.buffer_index = pd.DatetimeIndex(data['buffer_index'])
+            engine.checksums = pd.DataFrame(
+                {'hash': data['checksum_hash'], 'width': data['checksum_width']},
+                index=pd.DatetimeIndex(data['checksum_index']))
+        return engine
+
+    @classmethod
+    def load_or_create(cls, path, window=24 * 7, freq='h', source='', history=24 * 30):
+        """配置与缓存一致时复用缓存，否则丢弃旧统计量重新计算"""
+        engine = cls(window=window, freq=freq, source=source, history=history)
+        if not os.path.exists(path):
+            return engine
+        try:
+            cached = cls.load(path)
+        except Exception as e:
+            # 缓存损坏（截断、格式不符等）时重新计算即可
+            logging.warning(f"无法读取相关系数缓存，将重新计算：{e}")
+            return engine
+        if cached.config() != engine.config():
+            logging.info(f"缓存配置 {cached.config()} 与当前配置 {engine.config()} 不一致，将重新计算")
+            return engine
+        return cached
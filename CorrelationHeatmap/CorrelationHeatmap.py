@@ -2,35 +2,65 @@ import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 import os
+from CorrelationEngine import SeriesBuilder, CorrelationEngine
 
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+cache_path = os.path.join(current_dir, 'output', 'correlation_cache.npz')
 
-# Load the data
-df = pd.read_csv('Store/Transformed_data.csv')
+window = 24 * 7
+history = 24 * 30
+freq = 'h'
 
-# Select numeric columns for correlation
-numeric_columns = df.select_dtypes(include=['int64', 'float64']).columns
+# Load the data and attach sentiment scores where the analyzer has produced them
+sentiment_path = os.path.join(project_root, 'SentimentAnalyzer', 'output', 'Sentiment_data.csv')
+transformed_path = os.path.join(project_root, 'Store', 'Transformed_data.csv')
+raw_path = os.path.join(project_root, 'Store', 'Raw_data.csv')
+df = pd.read_csv(transformed_path).drop_duplicates('newsId', keep='last')
+if os.path.exists(sentiment_path):
+    sentiment = pd.read_csv(sentiment_path, usecols=['newsId', 'sentiment_label', 'sentiment_score'])
+    df = df.merge(sentiment.drop_duplicates('newsId', keep='last'), on='newsId', how='left')
+    print("Articles without sentiment:", int(df['sentiment_score'].isna().sum()), "of", len(df))
+raw_df = pd.read_csv(raw_path) if os.path.exists(raw_path) else None
 
-# Calculate the correlation matrix
-correlation_matrix = df[numeric_columns].corr()
+# Build aligned hourly series per category and per ticker
+series = SeriesBuilder(freq=freq).build(df, raw_df)
+print("Series built:", series.shape[1], "series x", series.shape[0], "hourly buckets")
 
+# Update the cached engine with new or revised buckets; rebuild if the settings or data changed
+source = f"{os.path.relpath(transformed_path, project_root)}@{series.index.min()}"
+engine = CorrelationEngine.load_or_create(cache_path, window=window, freq=freq,
+                                          source=source, history=history)
+engine.update(series)
+engine.save(cache_path)
+print(f"Correlation cache saved to '{cache_path}'")
+
+correlation_matrix = engine.correlation()
 print("Correlation matrix calculated.")
 print("Shape of the correlation matrix:", correlation_matrix.shape)
-print("\
-First few rows of the correlation matrix:")
-print(correlation_matrix.head())
+
+# Only plot the most active series; the full matrix stays in the cache
+top_n = 30
+volume_labels = [label for label in series.columns if label.endswith(':volume')]
+activity = series[volume_labels].sum()
+top_names = [label.rsplit(':', 1)[0] for label in activity.nlargest(top_n // 3).index]
+selected = [f"{name}:{metric}" for name in top_names for metric in SeriesBuilder.METRICS]
+selected = [label for label in selected if label in correlation_matrix.index]
+plot_matrix = correlation_matrix.loc[selected, selected]
 
 # Create a heatmap
-plt.figure(figsize=(10, 8))
-sns.heatmap(correlation_matrix, annot=True, cmap='coolwarm', vmin=-1, vmax=1, center=0)
+plt.rcParams['font.sans-serif'] = ['SimHei', 'DejaVu Sans', 'Arial Unicode MS']
+plt.rcParams['axes.unicode_minus'] = False
+plt.figure(figsize=(12, 10))
+sns.heatmap(plot_matrix, annot=len(selected) <= 15, cmap='coolwarm', vmin=-1, vmax=1, center=0)
 plt.title('Correlation Heatmap')
 plt.tight_layout()
 
 # Save the heatmap
-output_path = os.path.join(current_dir, 'time_series_trend.png')
+output_path = os.path.join(current_dir, 'output', 'correlation_heatmap.png')
 plt.savefig(output_path)
-print("Correlation heatmap has been saved as 'correlation_heatmap.png'")
+print(f"Correlation heatmap has been saved as '{output_path}'")
 
 # Display the heatmap
-plt.show()
\ No newline at end of file
+plt.show()